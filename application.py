@@ -4,22 +4,27 @@
 """"""
 
 import os
+import re
 import pwd
-import json
+import hashlib
+import time
+import atexit
 import logging
+import logging.handlers
 import calendar
-import urlparse
 import functools
+import concurrent.futures
+import urlparse
 
 try:
-    import configparser
+    from xmlrpc import client
 except ImportError:
-    import ConfigParser as configparser
+    import xmlrpclib as client
 
 try:
-    from xmlrpc import client
+    from html import escape
 except ImportError:
-    import xmlrpclib as client
+    from cgi import escape
 
 try:
     import raven
@@ -33,30 +38,72 @@ except ImportError:
 
 import flask
 import flask.views
-from flask import jsonify
+import requests
 from mimerender import FlaskMimeRender
 
-import slackclient
+import jsonrpclib.config
+import jsonrpclib.jsonrpc
 
 import tracxml
 import natural
 import trac_to_markdown
 
-from core import load_configuration
+from core import load_configuration, lru_cache, json_dumps, json_loads
 
 CONF = load_configuration()
+# Resolve the options used while handling requests only once.
+# Several comma separated tokens may be configured (e.g. while rotating
+# them), only their digests are kept.
+SLACK_TOKENS = frozenset(
+    hashlib.sha256(token.strip().encode("utf8")).digest()
+    for token in CONF.get("slack", "token").split(",")
+    if token.strip()
+)
+TRAC_HOST = CONF.get("trac", "host")
+TRAC_URL = "https://%s" % TRAC_HOST
+TRAC_LIMIT = int(CONF.get("trac", "limit"))
+# The (field, title) of each field shown when describing a ticket.
+DESCRIBE_FIELDS = tuple((field, field.title()) for field in
+                        CONF.get("trac", "describe_fields").split(","))
+ADJUST_FIELDS = tuple(field
+                      for field in CONF.get("trac", "adjust_fields").split(",")
+                      if field)
+EXAMPLE_ADJUST_DETAILS = CONF.get("trac", "example_adjust_details")
+ADJUST_TEMPLATES = {
+    field: CONF.get("trac", "adjust_template_%s" % field)
+    for field in ADJUST_FIELDS
+    if CONF.has_option("trac", "adjust_template_%s" % field)
+}
+# The name to use for links to a host in bug reports.
+LINK_NAMES = {
+    option[len("link_"):]: CONF.get("misc", option)
+    for option in CONF.options("misc")
+    if option.startswith("link_")
+}
+
+
+def render_json(**data):
+    return flask.Response(json_dumps(data), mimetype="application/json")
+
+
 # This is the WSGI application that we are creating.
 application = flask.Flask(__name__)
-mimerender = FlaskMimeRender()(default='json', json=jsonify)
-slack_client = slackclient.SlackClient(CONF.get("slack", "bot_token"))
+mimerender = FlaskMimeRender()(default='json', json=render_json)
+# Runs the work that does not need to finish before answering Slack.
+BACKGROUND_POOL = concurrent.futures.ThreadPoolExecutor(max_workers=8)
+# Seconds to wait for Slack when answering through a response URL.
+SLACK_TIMEOUT = 10
+
+
+# Number of log records kept in memory before being written to the file.
+LOG_BUFFER_CAPACITY = 200
 
 
-def setup_logging(logger):
+def setup_logging(logger, current_user, level):
     user = CONF.get("logging", "user")
     filename = CONF.get("logging", "file")
     sentry = CONF.get("logging", "sentry")
-    level = getattr(logging, CONF.get("logging", "level").upper())
-    if user and pwd.getpwuid(os.getuid()).pw_name != user:
+    if user and current_user != user:
         return
 
     formatter = logging.Formatter('%(asctime)s %(levelname)s %(message)s')
@@ -65,13 +112,19 @@ def setup_logging(logger):
     if filename:
         file_handler = logging.FileHandler(filename)
         file_handler.setFormatter(formatter)
-        file_handler.setLevel(level)
-        logger.addHandler(file_handler)
+        # Buffer the records so that requests don't wait on the disk for
+        # every message, errors are still written out immediately.
+        memory_handler = logging.handlers.MemoryHandler(
+            LOG_BUFFER_CAPACITY, flushLevel=logging.ERROR,
+            target=file_handler)
+        memory_handler.setLevel(level)
+        logger.addHandler(memory_handler)
+        atexit.register(memory_handler.flush)
 
     if sentry and _has_raven:
         client = raven.Client(sentry,
                               enable_breadcrumbs=False,
-                              transport=raven.transport.HTTPTransport)
+                              transport=raven.transport.ThreadedHTTPTransport)
         # Wrap the application in Sentry middleware.
         Sentry(application, client=client, logging=True,
                level=logging.WARN)
@@ -88,39 +141,50 @@ def setup_logging(logger):
             null_logger.handlers = [logging.NullHandler()]
 
 
-setup_logging(application.logger)
-setup_logging(natural.logger)
+_current_user = pwd.getpwuid(os.getuid()).pw_name
+_log_level = getattr(logging, CONF.get("logging", "level").upper())
+setup_logging(application.logger, _current_user, _log_level)
+setup_logging(natural.logger, _current_user, _log_level)
+
+
+def get_payload():
+    """Get the payload of an interactive Slack request.
+
+    The payload is only parsed once per request, it is needed both to
+    verify the token and by the view itself.
+    """
+    if "payload" not in flask.g:
+        flask.g.payload = json_loads(flask.request.form["payload"])
+    return flask.g.payload
 
 
 def verify_token():
     try:
         token = flask.request.form["token"]
     except KeyError:
-        token = json.loads(flask.request.form["payload"])["token"]
-    conf_token = CONF.get("slack", "token")
-    if token != conf_token:
+        token = get_payload()["token"]
+    if hashlib.sha256(token.encode("utf8")).digest() not in SLACK_TOKENS:
         return "Invalid token"
 
 
-application.before_request(verify_token)
+def require_slack_token(func):
+    """Only call the view if the request has a valid Slack token."""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        error = verify_token()
+        if error:
+            return error
+        return func(*args, **kwargs)
+    return wrapper
 
-try:
-    import jsonrpclib.config
-    import jsonrpclib.jsonrpc
-except ImportError:
-    trac_proxy = client.ServerProxy(
-        "https://%s:%s@%s/login/rpc" %
-        (CONF.get("trac", "user"), CONF.get("trac", "password"),
-         CONF.get("trac", "host")), transport=tracxml.SafeRequestsTransport()
-    )
-else:
-    jsonrpclib.config.use_jsonclass = False
-    trac_proxy = jsonrpclib.jsonrpc.ServerProxy(
-        "https://%s:%s@%s/login/rpc" %
-        (CONF.get("trac", "user"), CONF.get("trac", "password"),
-         CONF.get("trac", "host")),
-        transport=tracxml.SafeJSONRequestsTransport()
-    )
+
+jsonrpclib.config.use_jsonclass = False
+trac_proxy = jsonrpclib.jsonrpc.ServerProxy(
+    "https://%s:%s@%s/login/rpc" %
+    (CONF.get("trac", "user"), CONF.get("trac", "password"),
+     TRAC_HOST),
+    transport=tracxml.SafeJSONRequestsTransport()
+)
 
 INTRO = (u"Trac slash command allows you to query Trac tickets from slack. The "
          u"Trac slash command will do its best to interpret your query from "
@@ -139,8 +203,23 @@ BODY_TEXT = u"""
 
 HELP_TEXT = INTRO + BODY_TEXT
 
+# A bare ticket number, like "12345" or "#12345".
+TICKET_RE = re.compile(r"\s*#?(\d+)\s*$")
+
 QUERY_TEMPLATE = (u" • <https://%(host)s/ticket/%(number)s|#%(number)s> "
                   u"- %(summary)s")
+TICKET_URL_TEMPLATE = "https://%(host)s/ticket/%(number)s"
+QUERY_MORE_TEMPLATE = (u"_The rest of the results available "
+                       u"<https://%(host)s/query?%(query)s|here>_")
+QUERY_LINK_TEMPLATE = u"_See in <https://%(host)s/query?%(query)s|trac>_"
+
+# Attachment colors used when describing tickets of each type.
+TYPE_COLORS = {
+    "feature": "good",
+    "task": "warning",
+    "bug": "danger",
+}
+DEFAULT_COLOR = "#f5f5ef"
 
 BUG_DIALOG = {
     "title": "Create a Trac bug ticket",
@@ -184,24 +263,50 @@ BUG_DIALOG = {
 }
 
 
+def is_missing_ticket(error):
+    """Check if the RPC `error` is Trac saying the ticket doesn't exist."""
+    if isinstance(error, client.Fault):
+        code, message = error.faultCode, error.faultString
+    elif (error.args and isinstance(error.args[0], (tuple, list)) and
+            len(error.args[0]) == 2):
+        # jsonrpclib raises the (code, message) of the error response.
+        code, message = error.args[0]
+    else:
+        return False
+    return code == 404 or "does not exist" in (message or "")
+
+
 class QueryTrac(flask.views.MethodView):
-    _to_md = functools.partial(trac_to_markdown.convert,
-                               base="https://%s" % CONF.get("trac", "host"),
-                               flavour="mrkdwn")
+    decorators = [require_slack_token]
+
+    @staticmethod
+    def _to_md(text):
+        """Convert Trac's WikiFormatting to Slack's mrkdwn."""
+        return trac_to_markdown.convert(text, base=TRAC_URL, flavour="mrkdwn")
 
     @staticmethod
     def _escape(value):
-        return value.replace("&", "&amp;").replace("<", "&lt;").replace(">",
-                                                                        "&gt;")
+        return escape(value, quote=False)
+
+    @staticmethod
+    @lru_cache(maxsize=4096)
+    def _query_row(ticket, summary):
+        """Format the line listing a ticket in the query results."""
+        return QUERY_TEMPLATE % {"host": TRAC_HOST, "number": ticket,
+                                 "summary": QueryTrac._escape(summary)}
 
     @classmethod
-    def _get_tick_attributes(cls, ticket):
+    def _format_tick_attributes(cls, ticket, raw):
+        """Prepare the attributes of a ticket for display.
+
+        `raw` is the ticket as returned by Trac's ticket.get.
+        """
         escape = cls._escape
         to_md = cls._to_md
-        attributes = dict(trac_proxy.ticket.get(ticket)[3])
+        attributes = dict(raw[3])
         stamp = calendar.timegm(attributes['time'].timetuple())
         attributes["stamp"] = stamp
-        attributes["host"] = CONF.get("trac", "host")
+        attributes["host"] = TRAC_HOST
         attributes["number"] = str(ticket)
         attributes["summary"] = escape(attributes["summary"])
         attributes["description"] = to_md(escape(attributes["description"]))
@@ -214,56 +319,69 @@ class QueryTrac(flask.views.MethodView):
         return attributes
 
     def _handle_query(self, query):
-        limit = int(CONF.get("trac", "limit"))
-        result = []
+        limit = TRAC_LIMIT
         try:
             tickets = trac_proxy.ticket.query(query)
         except Exception:
             return {"text": ("Oops, something went wrong! :sweat:\n"
                              "The query might not be valid?")}
         total_tickets = len(tickets)
-        for ticket in tickets[:limit]:
-            attr = self._get_tick_attributes(ticket)
-            result.append(QUERY_TEMPLATE % attr)
+        # Fetch all the shown tickets in a single round trip.
+        shown = tickets[:limit]
+        calls = [("ticket.get", (ticket,)) for ticket in shown]
+        fetched = tracxml.multicall(trac_proxy, calls)
+        result = [self._query_row(ticket, raw[3]["summary"])
+                  for ticket, raw in zip(shown, fetched)
+                  if not isinstance(raw, client.Fault)]
+        if len(result) != len(shown):
+            application.logger.warning("Unable to get %s tickets for %r",
+                                       len(shown) - len(result), query)
+        links = {"host": TRAC_HOST, "query": query}
         if total_tickets > limit:
             result.append("")
             result.append("_%s tickets not shown!_" % (total_tickets - limit))
-            result.append("_The rest of the results available "
-                          "<https://%s/query?%s|here>_" %
-                          (CONF.get("trac", "host"), query))
+            result.append(QUERY_MORE_TEMPLATE % links)
         elif not total_tickets:
             result.append("No tickets found")
-            result.append("_See in <https://%s/query?%s|trac>_" %
-                          (CONF.get("trac", "host"), query))
+            result.append(QUERY_LINK_TEMPLATE % links)
         else:
-            result.append("_See in <https://%s/query?%s|trac>_" %
-                          (CONF.get("trac", "host"), query))
+            result.append(QUERY_LINK_TEMPLATE % links)
         return {"text": "\n".join(result), "response_type": "in_channel"}
 
     @classmethod
     def handle_describe(cls, query):
-        try:
-            ticket = trac_proxy.ticket.query(query)[0]
-        except IndexError:
-            # This should be ephemeral
-            return {"text": "No such ticket"}
-        attr = cls._get_tick_attributes(ticket)
-        color = "#f5f5ef"
-        if attr["type"] == "feature":
-            color = "good"
-        elif attr["type"] == "task":
-            color = "warning"
-        elif attr["type"] == "bug":
-            color = "danger"
-        fields = [
-            {
-                "title": field.title(),
-                "value": attr.get(field, "_(unknown)_"),
-                "short": True,
-            }
-            for field in CONF.get("trac", "describe_fields").split(",")
-            if attr[field]
-            ]
+        if query.startswith("id="):
+            # ticket.get already tells us whether the ticket exists, so
+            # there is no need to run a query first.
+            try:
+                raw = trac_proxy.ticket.get(int(query[3:].lstrip("#")))
+            except ValueError:
+                # This should be ephemeral
+                return {"text": "No such ticket"}
+            except (client.Fault, jsonrpclib.jsonrpc.ProtocolError) as e:
+                if is_missing_ticket(e):
+                    # This should be ephemeral
+                    return {"text": "No such ticket"}
+                application.logger.exception("Unable to get %s", query)
+                raise
+        else:
+            try:
+                ticket = trac_proxy.ticket.query(query)[0]
+            except IndexError:
+                # This should be ephemeral
+                return {"text": "No such ticket"}
+            raw = trac_proxy.ticket.get(ticket)
+        attr = cls._format_tick_attributes(raw[0], raw)
+        color = TYPE_COLORS.get(attr["type"], DEFAULT_COLOR)
+        fields = []
+        for field, title in DESCRIBE_FIELDS:
+            value = attr.get(field)
+            if value:
+                fields.append({
+                    "title": title,
+                    "value": value,
+                    "short": True,
+                })
         return {
             "response_type": "in_channel",
             "attachments": [
@@ -272,8 +390,8 @@ class QueryTrac(flask.views.MethodView):
                     "color": color,
                     "title": attr["summary"],
                     "author_name": attr["owner"],
-                    "title_link": "https://%(host)s/ticket/%(number)s" % attr,
-                    "text": cls._to_md(attr["description"]),
+                    "title_link": TICKET_URL_TEMPLATE % attr,
+                    "text": attr["description"],
                     "fields": fields,
                     "footer": "#%(number)s" % attr,
                     "ts": attr["stamp"],
@@ -286,10 +404,9 @@ class QueryTrac(flask.views.MethodView):
         return {"text": HELP_TEXT}
 
     def handle_adjust(self, user, query):
-        possible_fields = CONF.get("trac", "adjust_fields")
+        possible_fields = ADJUST_FIELDS
         if not possible_fields:
             return {"text": "Sorry, I'm not set up for this yet."}
-        possible_fields = possible_fields.split(",")
         try:
             ticket_id, field, value, details = query.split(None, 3)
         except ValueError:
@@ -314,17 +431,13 @@ class QueryTrac(flask.views.MethodView):
         try:
             ticket_id = int(ticket_id.lstrip("#"))
         except ValueError:
-            example_details = CONF.get("trac", "example_adjust_details")
             return {
                 "text": "Sorry, I didn't understand that. I'm expecting "
                 "`adjust [ticket id] [field] [value] [details]`, like "
                 "`adjust #12345 %s 5 %s`" %
-                (possible_fields[0], example_details)}
-        try:
-            template = CONF.get("trac", "adjust_template_%s" % field)
-        except configparser.NoOptionError:
-            pass
-        else:
+                (possible_fields[0], EXAMPLE_ADJUST_DETAILS)}
+        template = ADJUST_TEMPLATES.get(field)
+        if template is not None:
             details = template % {"details": details, "value": value}
         attributes = dict(trac_proxy.ticket.get(ticket_id)[3])
         if attributes[field]:
@@ -364,49 +477,52 @@ class QueryTrac(flask.views.MethodView):
             ],
         }
 
+    def _command_describe(self, user, query):
+        return self.handle_describe("id=%s" % query)
+
+    def _command_show(self, user, query):
+        query = natural.natural_to_query(query, user)
+        if not query:
+            # Might be nice to have random responses.
+            return {
+                "text": ("Didn't quite get that :thinking_face: \n"
+                         "Have you tried quoting your text searches?")}
+        return self._handle_query(query)
+
+    def _command_query(self, user, query):
+        return self._handle_query(query)
+
+    commands = {
+        "describe": _command_describe,
+        "show": _command_show,
+        "query": _command_query,
+        "adjust": handle_adjust,
+    }
+
     @mimerender
     def post(self):
         text = flask.request.form["text"]
         user = flask.request.form["user_name"]
-        if text.lower() == "help":
+        text_lower = text.lower()
+        if text_lower == "help":
             return self.handle_help()
-        if text.lower() == "bug":
+        if text_lower == "bug":
             return self.handle_new_bug()
+        ticket_match = TICKET_RE.match(text)
+        if ticket_match:
+            return self.handle_describe("id=%s" % ticket_match.group(1))
 
         try:
             command, query = text.split(None, 1)
-            assert command.lower() in ("describe", "show", "query", "adjust")
-        except (ValueError, AssertionError):
+            handler = self.commands[command.lower()]
+        except (ValueError, KeyError):
             # Try to figure out what the user wants
-            try:
-                command, query = "describe", int(text.lstrip('#'))
-            except (ValueError, TypeError):
-                query = text
-                if "=" in text or "&" in text:
-                    command = "query"
-                else:
-                    command = "show"
-
-        command = command.lower()
-        if command == "describe":
-            return self.handle_describe("id=%s" % query)
-
-        if command == "adjust":
-            return self.handle_adjust(user, query)
-
-        if command == "show":
-            query = natural.natural_to_query(query, user)
-            if not query:
-                # Might be nice to have random responses.
-                return {
-                    "text": ("Didn't quite get that :thinking_face: \n"
-                             "Have you tried quoting your text searches?")}
-            return self._handle_query(query)
-
-        if command == "query":
-            return self._handle_query(query)
-
-        return {"text": "Invalid command: %s" % command}
+            query = text
+            if "=" in text or "&" in text:
+                handler = self.commands["query"]
+            else:
+                handler = self.commands["show"]
+        return handler(self, user, query)
 
 
 application.add_url_rule(
@@ -438,58 +554,127 @@ BUG_TEMPLATE = """%(description)s
 """
 
 
+@lru_cache(maxsize=1)
+def get_slack_client():
+    """Get the client used to call Slack's Web API.
+
+    This is only needed for bug reports, so slackclient is only imported
+    once the first one is made.
+    """
+    import slackclient
+    return slackclient.SlackClient(CONF.get("slack", "bot_token"))
+
+
+def bug_submission_errors(form):
+    """Check the bug dialog submission before creating the ticket.
+
+    Returns the errors in the format Slack expects for dialogs.
+    """
+    errors = []
+    if not form.get("description", "").partition(".")[0].strip():
+        errors.append({"name": "description",
+                       "error": "Start with a one sentence summary."})
+    return errors
+
+
 def new_bug_ticket(user, data, component):
-    team = data["channel"]["name"].title()
+    """Create a bug ticket from the dialog submission and post it to the
+    channel.
+
+    This runs in the background, so failures are only logged.
+    """
     form = data["submission"]
-    application.logger.info("Bug ticket: %r", form)
-    summary, description = form["description"].split(".", 1)
-    reporter = user
-    ticket_type = "bug"
-    priority = "normal"
-    if form.get("link"):
-        link_name = urlparse.urlparse(form["link"]).netloc
-        try:
-            link_name = CONF.get("misc", "link_%s" % link_name)
-        except (configparser.NoSectionError, configparser.NoOptionError):
-            link_name = link_name.split(".", 1)[0].title()
+    try:
+        team = data["channel"]["name"].title()
+        application.logger.info("Bug ticket: %r", form)
+        # The first sentence is the summary, the rest the description.
+        summary, _, description = form["description"].partition(".")
+        reporter = user
+        ticket_type = "bug"
+        priority = "normal"
+        if form.get("link"):
+            netloc = urlparse.urlparse(form["link"]).netloc
+            link_name = LINK_NAMES.get(netloc.lower())
+            if link_name is None:
+                link_name = netloc.split(".", 1)[0].title()
+        else:
+            link_name = ""
+        description = BUG_TEMPLATE % {
+            "description": description.strip(),
+            "version": form["version"],
+            "steps": form.get("reproduce") or "",
+            "log": form.get("log") or "",
+            "link": form.get("link") or "",
+            "link_name": link_name,
+        }
+        ticket_id = trac_proxy.ticket.create(
+            summary,
+            description,
+            {
+                "team": team,
+                "reporter": user,
+                "type": ticket_type,
+                "priority": priority,
+                "component": component,
+            },
+            True)
+        # Post a message to show the ticket was created.
+        response = QueryTrac.handle_describe("id=%s" % ticket_id)
+        get_slack_client().api_call(
+            "chat.postMessage", channel=data["channel"]["id"],
+            attachments=response["attachments"])
+    except Exception:
+        application.logger.exception("Unable to create bug ticket %r", form)
+
+
+def update_tickets(tickets, changes, user, response_url):
+    """Apply the same changes to several tickets in a single round trip.
+
+    This runs in the background, so failures are logged and reported back
+    to the user through the `response_url` of the Slack action.
+    """
+    try:
+        calls = [("ticket.update", (int(ticket), "", changes, True, user))
+                 for ticket in tickets]
+        results = tracxml.multicall(trac_proxy, calls)
+    except Exception:
+        application.logger.exception("Unable to update tickets %s", tickets)
+        failed = tickets
     else:
-        link_name = ""
-    description = BUG_TEMPLATE % {
-        "description": description.strip(),
-        "version": form["version"],
-        "steps": form.get("reproduce") or "",
-        "log": form.get("log") or "",
-        "link": form.get("link") or "",
-        "link_name": link_name,
-    }
-    ticket_id = trac_proxy.ticket.create(
-        summary,
-        description,
-        {
-            "team": team,
-            "reporter": user,
-            "type": ticket_type,
-            "priority": priority,
-            "component": component,
-        },
-        True)
-    # Post a message to show the ticket was created.
-    response = QueryTrac.handle_describe("id=%s" % ticket_id)
-    slack_client.api_call(
-        "chat.postMessage", channel=data["channel"]["id"],
-        attachments=response["attachments"])
-    return ""
+        failed = [ticket for ticket, result in zip(tickets, results)
+                  if isinstance(result, client.Fault)]
+    if not failed:
+        return
+    application.logger.warning("Unable to apply %r to tickets %s", changes,
+                               failed)
+    if response_url:
+        text = ("Sorry, I couldn't update %s :sweat:" %
+                ", ".join(["#%s" % ticket for ticket in failed]))
+        try:
+            requests.post(response_url, json={"text": text,
+                                              "response_type": "ephemeral",
+                                              "replace_original": False},
+                          timeout=SLACK_TIMEOUT)
+        except requests.RequestException:
+            application.logger.exception("Unable to report failed updates "
+                                         "to %s", response_url)
 
 
 @application.route(CONF.get("slack", "action-endpoint"), methods=['POST'])
+@require_slack_token
 def slack_action():
     """Route the action to the appropriate method."""
-    data = json.loads(flask.request.form["payload"])
+    data = get_payload()
     user = data["user"]["name"]
     if data["type"] == "dialog_submission":
         if data["callback_id"].startswith("new_bug_"):
             component = data["callback_id"].split("_")[2]
-            return new_bug_ticket(user, data, component)
+            errors = bug_submission_errors(data["submission"])
+            if errors:
+                return render_json(errors=errors)
+            # Slack expects an answer within 3 seconds, don't wait for Trac.
+            BACKGROUND_POOL.submit(new_bug_ticket, user, data, component)
+            return ""
     callback_id = data["callback_id"]
     if callback_id.startswith("adjust_"):
         field, tickets = callback_id.split("_")[1:]
@@ -503,35 +688,47 @@ def slack_action():
         action = data["actions"][0]
         # We only support one option.
         option = action["selected_options"][0]["value"]
-        for ticket in tickets:
-            changes = {field: option}
-            trac_proxy.ticket.update(int(ticket), "", changes, True, user)
+        # Slack expects an answer within 3 seconds, don't wait for Trac.
+        BACKGROUND_POOL.submit(update_tickets, tickets, {field: option}, user,
+                               data.get("response_url"))
         return ("@%s set %s to %s for %s" %
                 (user, field, option, ticket_desc))
     elif callback_id.startswith("new_bug"):
-        dialog = BUG_DIALOG.copy()
         component = data["actions"][0]["selected_options"][0]["value"]
         trigger_id = data["trigger_id"]
-        dialog["callback_id"] = "new_bug_%s" % component
-        open_dialog = slack_client.api_call("dialog.open", trigger_id=trigger_id,
-                                            dialog=dialog)
+        dialog = dict(BUG_DIALOG, callback_id="new_bug_%s" % component)
+        open_dialog = get_slack_client().api_call(
+            "dialog.open", trigger_id=trigger_id, dialog=dialog)
     return "Unknown action."
 
 
+# Seconds during which the list of components is reused before asking
+# Trac for it again.
+COMPONENTS_TTL = 60
+_components = {"expires": 0, "names": []}
+
+
+def get_components():
+    """Get the (name, lowercase name) of each of Trac's components."""
+    now = time.time()
+    if now >= _components["expires"]:
+        names = trac_proxy.ticket.component.getAll()
+        _components["names"] = [(name, name.lower()) for name in names]
+        _components["expires"] = now + COMPONENTS_TTL
+    return _components["names"]
+
+
 @application.route(CONF.get("slack", "options-endpoint"), methods=['POST'])
+@require_slack_token
 @mimerender
 def slack_options():
     """Provide options when users invoke message menus."""
-    data = json.loads(flask.request.form["payload"])
+    data = get_payload()
     if data["name"] == "component":
-        try:
-            typeahead = data["value"]
-        except KeyError:
-            typeahead = ""
-        response = []
-        for component in trac_proxy.ticket.component.getAll():
-            if not typeahead or component.lower().startswith(typeahead):
-                response.append({"text": component, "value": component})
+        typeahead = data.get("value", "").lower()
+        response = [{"text": component, "value": component}
+                    for component, lower in get_components()
+                    if lower.startswith(typeahead)]
         return {"options": response}
 
 
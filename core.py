@@ -5,47 +5,80 @@ try:
 except ImportError:
     import ConfigParser as configparser
 
+try:
+    from functools import lru_cache
+except ImportError:
+    from backports.functools_lru_cache import lru_cache
 
-def load_configuration():
-    defaults = {
-        "trac": {
-            "host": "",
-            "user": "",
-            "password": "",
-            "limit": "35",
-            "components": "",
-            "priorities": "lowest,low,normal,high,highest",
-            "types": "defect,enhancement,task",
-            "extra_fields": "",
-            "statuses": "",
-            "resolutions": "fixed,invalid,wontfix,duplicate,worksforme,cantfix",
-            "describe_fields": "type,component,priority,status+,milestone",
-        },
-        "misc": {
-            "bug_dialog_link_hint": "",
-            "bug_dialog_version_hint": "",
-        },
-        "fixed_queries": {},
-        "slack": {
-            "token": "",
-            "endpoint": "/trac-slack",
-            "action-endpoint": "/trac-slack-action",
-            "options-endpoint": "/trac-slack-options",
-        },
-        "logging": {
-            "file": "/var/log/trac-slack.log",
-            "level": "INFO",
-            "sentry": "",
-            "user": "www-data",
-        }
+try:
+    from orjson import dumps as json_dumps, loads as json_loads
+except ImportError:
+    try:
+        from ujson import dumps as json_dumps, loads as json_loads
+    except ImportError:
+        from json import dumps as json_dumps, loads as json_loads
+
+CONFIG_FILE = "/etc/trac-slack.conf"
+
+DEFAULTS = {
+    "trac": {
+        "host": "",
+        "user": "",
+        "password": "",
+        "limit": "35",
+        "components": "",
+        "priorities": "lowest,low,normal,high,highest",
+        "types": "defect,enhancement,task",
+        "extra_fields": "",
+        "statuses": "",
+        "resolutions": "fixed,invalid,wontfix,duplicate,worksforme,cantfix",
+        "describe_fields": "type,component,priority,status+,milestone",
+        "adjust_fields": "",
+        "example_adjust_details": "",
+    },
+    "misc": {
+        "bug_dialog_link_hint": "",
+        "bug_dialog_version_hint": "",
+    },
+    "fixed_queries": {},
+    "slack": {
+        "token": "",
+        "bot_token": "",
+        "endpoint": "/trac-slack",
+        "action-endpoint": "/trac-slack-action",
+        "options-endpoint": "/trac-slack-options",
+    },
+    "logging": {
+        "file": "/var/log/trac-slack.log",
+        "level": "INFO",
+        "sentry": "",
+        "user": "www-data",
     }
+}
+
+
+def load_configuration():
+    """Load the configuration, reusing the already parsed one as long as
+    the file has not changed.
+    """
+    try:
+        stat = os.stat(CONFIG_FILE)
+    except OSError:
+        version = None
+    else:
+        version = (stat.st_mtime, stat.st_size)
+    return _load_configuration(version)
+
+
+@lru_cache(maxsize=1)
+def _load_configuration(version):
     conf = configparser.RawConfigParser()
     # Load in default values.
-    for section, values in defaults.items():
+    for section, values in DEFAULTS.items():
         conf.add_section(section)
         for option, value in values.items():
             conf.set(section, option, value)
 
-    if os.path.exists("/etc/trac-slack.conf"):
-        conf.read("/etc/trac-slack.conf")
+    if version is not None:
+        conf.read(CONFIG_FILE)
     return conf
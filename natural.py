@@ -12,67 +12,98 @@
 from __future__ import print_function
 
 import re
+import sys
+import time
 import getpass
 import logging
 import argparse
 import datetime
 import functools
+import itertools
 
-from core import load_configuration
+from core import load_configuration, lru_cache
 
-import spacy.en
 import dateparser
 from dateutil.relativedelta import relativedelta
 
 CONF = load_configuration()
-nlp = spacy.en.English()
 logger = logging.getLogger("trac-slack-nlp")
+# Set by `main` with --debug, so the logs explaining how each query is
+# built are not lost to the cache.
+SKIP_CACHE = False
 
-negations = {
+# dateparser compiles more patterns than fit in the re module's cache,
+# which then gets cleared and everything recompiled on most calls.
+re._MAXCACHE = max(getattr(re, "_MAXCACHE", 0), 4096)
+
+negations = frozenset({
     "no", "not", "n't", "never", "none", "unlike", "different",
     "dissimilar", "unequal",
-}
-partials = {
+})
+partials = frozenset({
     "has", "like", "contains", "alike", "related", "close", "matching",
     "near", "matching", "akin", "relating", "resembling", "fuzzy",
     "contain", "in", "isin",
-}
-negated_partials = {
+})
+negated_partials = frozenset({
     "notin", "notlike", "isnotin",
-}
-exacts = {
+})
+exacts = frozenset({
     "is", "exactly", "exact", "equals", "same", "identical", "specific",
     "'ve", "have",
-}
-negated_exacts = {
+})
+negated_exacts = frozenset({
     "isnot",
-}
-startings = {
+})
+startings = frozenset({
     "starts", "start", "begin", "begins"
-}
-endings = {
+})
+endings = frozenset({
     "ends", "end"
-}
-mes = {
+})
+mes = frozenset({
     "me", "my", "i", "tome",
-}
-change_modifiers = {
+})
+change_modifiers = frozenset({
     "changed", "change", "modified",
-}
-on_date = {
+})
+on_date = frozenset({
     "on",
-}
-start_date = {
+})
+start_date = frozenset({
     "from", "since", "after",
-}
-end_date = {
+})
+end_date = frozenset({
     "to", "before",
-}
-
-match_re = re.compile(r"""
-    (?<=\s)(('.*?')|(".*?")) |
-    ^(('.*?')|(".*?"))
-""", re.X)
+})
+ago_words = frozenset({
+    "ago", "last", "past",
+})
+# Parts of speech that can't be the value of a filter.
+skip_pos = frozenset({
+    "ADP", "DET", "PUNCT", "CONJ",
+})
+
+# Map each operator word to the operator it sets (if any) and whether it
+# negates the rest of the filter. The first set a word is found in wins,
+# in the same order get_filter used to check them.
+OPERATORS = {}
+for _words, _operator in (
+        (partials, ("=~", False)),
+        (negated_partials, ("=!~", True)),
+        (exacts, ("=", False)),
+        (negated_exacts, ("=!", True)),
+        (negations, (None, True)),
+        (startings, ("=^", False)),
+        (endings, ("=$", False)),
+):
+    for _word in _words:
+        OPERATORS.setdefault(_word, _operator)
+# The negated form of each operator that isn't negated.
+NEGATED_OPERATORS = {"=": "=!", "=~": "=!~", "=^": "=!^", "=$": "=!$"}
+
+# Quoted texts at the start of the query or after whitespace.
+match_re = re.compile(r"""(?<!\S)(?:'[^'\n]*'|"[^"\n]*")""")
 date_re = re.compile(r"""
 (
     (?:\s|^)
@@ -101,10 +132,23 @@ REPL = {
 def _is_something(tok, checks=None):
     if checks is None:
         return False
-    for dep in list(tok.lefts) + list(tok.rights):
-        if dep.lower_ in checks:
-            return True
-    return False
+    return any(dep.lower_ in checks
+               for dep in itertools.chain(tok.lefts, tok.rights))
+
+
+def _replacer(replacements):
+    """Get a function applying all the `replacements` to a text in a
+    single pass.
+
+    Longer keys are tried first, so that "is not in" wins over "is not".
+    """
+    keys = sorted((key for key in replacements if key), key=len,
+                  reverse=True)
+    if not keys:
+        return lambda text: text
+    regex = re.compile("|".join(re.escape(key) for key in keys))
+    return functools.partial(regex.sub,
+                             lambda match: replacements[match.group()])
 
 
 is_negated = functools.partial(_is_something, checks=negations)
@@ -117,9 +161,14 @@ UNIQUE_F = "57eaba821d58"
 
 # Order is important here.
 PRIORITIES = CONF.get("trac", "priorities").split(",")
+PRIORITIES_SET = frozenset(PRIORITIES)
+PRIORITY_INDEX = {_priority: i for i, _priority in enumerate(PRIORITIES)}
 
-TICKET_TYPES = {_type: _type for _type in CONF.get("trac", "types").split(",")}
-TICKET_TYPES.update({_type + "s": _type for _type in TICKET_TYPES})
+# Keys are lowercase, like the tokens they are looked up with.
+TICKET_TYPES = {_type.lower(): _type
+                for _type in CONF.get("trac", "types").split(",")}
+TICKET_TYPES.update({_key + "s": _type
+                     for _key, _type in TICKET_TYPES.items()})
 
 # XXX We should tokenize these the same way to tokenize
 # XXX status options.
@@ -130,15 +179,19 @@ REVERSED_COMPONENTS = {str(i) + UNIQUE_C: _comp
                        for i, _comp in enumerate(_COMPONENTS)}
 
 STATUSES = CONF.get("trac", "statuses").split(",")
+STATUSES_SET = frozenset(STATUSES)
 # Tokenize statuses as these can be compound words.
-# Stores a maping of a frozen set of tokens to the
+# Each status token gets a bit, and this stores a
+# maping of the bits of a status' tokens to the
 # actual status.
 TOKENIZED_STATUSES = {}
 TRANSLATE_STATUS_TOKENS = {}
+STATUS_TOKEN_BITS = {}
 for _status in STATUSES:
-    _status_tokens = set()
+    _status_mask = 0
     for _status_token in _status.split("_"):
-        _status_tokens.add(_status_token)
+        _status_mask |= STATUS_TOKEN_BITS.setdefault(
+            _status_token, 1 << len(STATUS_TOKEN_BITS))
 
         # Add the status token to the translation dictionary.
         # These are FAR from being accurate, but they get the
@@ -161,7 +214,11 @@ for _status in STATUSES:
         if _status_token.endswith("e"):
             TRANSLATE_STATUS_TOKENS[_status_token + "d"] = _status_token
             TRANSLATE_STATUS_TOKENS[_status_token[:-1] + "ing"] = _status_token
-    TOKENIZED_STATUSES[frozenset(_status_tokens)] = _status
+    TOKENIZED_STATUSES[_status_mask] = _status
+# The bit of the status token each word translates to.
+STATUS_WORD_BITS = {_word: STATUS_TOKEN_BITS[_status_token]
+                    for _word, _status_token
+                    in TRANSLATE_STATUS_TOKENS.items()}
 
 FIXED_QUERIES = {
     _fixed: str(i) + UNIQUE_F
@@ -172,6 +229,10 @@ FIXED_QUERIES_REVERSED = {
     for i, _fixed in enumerate(CONF.options("fixed_queries"))
     }
 
+replace_fixed_queries = _replacer(FIXED_QUERIES)
+replace_components = _replacer(COMPONENTS)
+replace_expressions = _replacer(REPL)
+
 # Known filters names
 KNOWN = {
     "cc": "cc",
@@ -197,6 +258,7 @@ KNOWN.update({field.lower(): field
               for field in CONF.get("trac", "extra_fields").split(",")})
 
 RESOLUTIONS = CONF.get("trac", "resolutions").split(",")
+RESOLUTIONS_SET = frozenset(RESOLUTIONS)
 
 NUMBERS = {
     "one": 1,
@@ -224,7 +286,7 @@ NUMBERS = {
 
 def get_filter(token, texts, user, already_processed, curr_filter=None,
                negates=False, level=0):
-    if token in already_processed:
+    if token.i in already_processed:
         logger.debug("Skipped Filter (level:%s): %s (%s)", level, token,
                      curr_filter)
         return
@@ -232,143 +294,180 @@ def get_filter(token, texts, user, already_processed, curr_filter=None,
     # filter. By default the filter is not negated.
     if curr_filter is None:
         curr_filter = {"not": False, "list": False, "status_tokens": set(),
-                       "extra_tokens": []}
-    original_curr_filter = {
-        "name": curr_filter.get("name", None),
-        "op": curr_filter.get("op", None),
-        "val": curr_filter.get("val", None),
+                       "status_mask": 0, "extra_tokens": [],
+                       "processed_tokens": []}
+    # Local names for what is looked up for every token.
+    known = KNOWN
+    operators = OPERATORS
+    status_word_bits = STATUS_WORD_BITS
+    status_tokens = curr_filter["status_tokens"]
+    extra_tokens = curr_filter["extra_tokens"]
+    processed_tokens = curr_filter["processed_tokens"]
+    # Go through the semantic tree, depth first, and
+    # figure out the rest of the filter values.
+    stack = [(token, negates, level)]
+    while stack:
+        token, negates, level = stack.pop()
+        if token.i in already_processed:
+            logger.debug("Skipped Filter (level:%s): %s (%s)", level, token,
+                         curr_filter)
+            continue
+        # Reading these from spaCy isn't free, and most are
+        # needed more than once.
+        lower = token.lower_
+        orth = token.orth_
+        original_name = curr_filter.get("name")
+        original_op = curr_filter.get("op")
+        original_val = curr_filter.get("val")
+        full = ("name" in curr_filter and "op" in curr_filter and
+                "val" in curr_filter)
+        processed = True
+        operator = operators.get(lower)
+        if lower in known and "name" not in curr_filter:
+            # We know this filter type
+            curr_filter["name"] = known[lower]
+        elif operator is not None and (
+                "op" not in curr_filter if operator[0] is not None
+                else not curr_filter["not"]):
+            op, negated = operator
+            if op is not None:
+                curr_filter["op"] = op
+            if negated:
+                curr_filter["not"] = True
+                # Any following token in the tree should be
+                # negated
+                negates = True
+        elif orth in REVERSED_COMPONENTS and not full:
+            # The user made it easy, this is
+            # a component filter.
+            curr_filter["name"] = "component"
+            if "op" not in curr_filter:
+                curr_filter["op"] = "="
+            curr_filter["val"] = REVERSED_COMPONENTS[orth]
+        elif orth in texts:
+            # The user made it easy, this is a quoted
+            # string, so it's the value.
+            curr_filter["val"] = texts[orth]
+            # If this is just a string, then it's likely
+            # the user wants to search the description.
+            # XXX Not really sure if this would be best
+            # if "name" not in curr_filter:
+            #     curr_filter["name"] = "description"
+            #     curr_filter["op"] = "=~"
+            if "op" not in curr_filter:
+                curr_filter["op"] = "="
+        elif lower in PRIORITIES_SET and not full:
+            # We already know the list of priorities
+            # and this is an exact match.
+            curr_filter["name"] = "priority"
+            if "op" not in curr_filter:
+                curr_filter["op"] = "="
+            curr_filter["val"] = orth
+        elif lower in TICKET_TYPES and not full:
+            # We already know the list of ticket types
+            # and this is an exact match.
+            curr_filter["name"] = "type"
+            if "op" not in curr_filter:
+                curr_filter["op"] = "="
+            curr_filter["val"] = TICKET_TYPES[lower]
+        elif (orth == "higher" and
+                      curr_filter.get("name", "") == "priority"
+              and "val" in curr_filter):
+            # The user want all priorities higher than
+            # the specified one.
+            curr_val = curr_filter["val"]
+            values = PRIORITIES[PRIORITY_INDEX[curr_val]:]
+            curr_filter["list"] = True
+            curr_filter["val"] = values
+        elif (orth == "lower" and
+                curr_filter.get("name", "") == "priority"
+                and "val" in curr_filter):
+            # The user want all priorities lower than
+            # the specified one.
+            curr_val = curr_filter["val"]
+            values = PRIORITIES[:PRIORITY_INDEX[curr_val] + 1]
+            curr_filter["list"] = True
+            curr_filter["val"] = values
+        elif lower in STATUSES_SET and not full:
+            # The user specified the exact status.
+            curr_filter["name"] = "status"
+            if "op" not in curr_filter:
+                curr_filter["op"] = "="
+            curr_filter["val"] = orth
+        elif lower in RESOLUTIONS_SET and not full:
+            # The user specified the exact resolution.
+            curr_filter["name"] = "resolution"
+            if "op" not in curr_filter:
+                curr_filter["op"] = "="
+            curr_filter["val"] = orth
+        elif (lower in mes and not full and
+                      "val" not in curr_filter):
+            curr_filter["val"] = user
+        elif ("name" in curr_filter and "op" in curr_filter and
+                      "val" not in curr_filter and
+                      token.pos_ not in skip_pos):
+            # We already have the other two,
+            # this is likely the value.
+            # XXX Risky assumption.
+            curr_filter["val"] = orth
+        elif orth in on_date and level == 0:
+            curr_filter["name"] = "on"
+        elif orth in start_date and level == 0:
+            curr_filter["name"] = "from"
+        elif orth in end_date and level == 0:
+            curr_filter["name"] = "to"
+        else:
+            extra_tokens.append(token)
+            processed = False
+
+        if orth in status_word_bits:
+            status_tokens.add(token)
+            curr_filter["status_mask"] |= status_word_bits[orth]
+
+        if processed:
+            already_processed.add(token.i)
+            processed_tokens.append(token)
+            if negates and "!" not in curr_filter.get("op", "!"):
+                curr_filter["op"] = NEGATED_OPERATORS[curr_filter["op"]]
+        # Remember which token set each part of the filter.
+        if curr_filter.get("name") != original_name:
+            curr_filter["name_"] = token
+        if curr_filter.get("op") != original_op:
+            curr_filter["op_"] = token
+        if curr_filter.get("val") != original_val:
+            curr_filter["val_"] = token
+        logger.debug("Get Filter (level:%s): %s (%s)", level, token,
+                     curr_filter)
+        # Push the children reversed, so they are visited in
+        # order, like the recursive walk did.
+        stack.extend((child, negates, level + 1)
+                     for child in reversed(list(token.children)))
+    return curr_filter
+
+
+@lru_cache(maxsize=1)
+def _date_interpolation(now):
+    """Get the date values fixed queries can use for the day `now`."""
+    return {
+        "month": now.strftime("%B"),
+        "year": now.strftime("%Y"),
+        "day": now.strftime("%d"),
+        "last_month": (now - relativedelta(months=1)).strftime("%B"),
+        "last_month_year":
+            (now - relativedelta(months=1)).strftime("%Y"),
+        "last_year": (now - relativedelta(years=1)).strftime("%Y"),
+        "yesterday": (now - relativedelta(days=1)).strftime("%d"),
     }
-    full = "name" in curr_filter and "op" in curr_filter and "val" in curr_filter
-    processed = True
-    if token.orth_ in KNOWN and "name" not in curr_filter:
-        # We know this filter type
-        curr_filter["name"] = KNOWN[token.orth_]
-    elif token.lower_ in partials and "op" not in curr_filter:
-        curr_filter["op"] = "=~"
-    elif token.lower_ in negated_partials and "op" not in curr_filter:
-        curr_filter["op"] = "=!~"
-        curr_filter["not"] = True
-        # Any following token in the tree should be
-        # negated
-        negates = True
-    elif token.lower_ in exacts and "op" not in curr_filter:
-        curr_filter["op"] = "="
-    elif token.lower_ in negated_exacts and "op" not in curr_filter:
-        curr_filter["op"] = "=!"
-        curr_filter["not"] = True
-        # Any following token in the tree should be
-        # negated
-        negates = True
-    elif token.lower_ in negations and not curr_filter["not"]:
-        curr_filter["not"] = True
-        # Any following token in the tree should be
-        # negated
-        negates = True
-    elif token.lower_ in startings and "op" not in curr_filter:
-        curr_filter["op"] = "=^"
-    elif token.lower_ in endings and "op" not in curr_filter:
-        curr_filter["op"] = "=$"
-    elif token.orth_ in REVERSED_COMPONENTS and not full:
-        # The user made it easy, this is
-        # a component filter.
-        curr_filter["name"] = "component"
-        if "op" not in curr_filter:
-            curr_filter["op"] = "="
-        curr_filter["val"] = REVERSED_COMPONENTS[token.orth_]
-    elif token.orth_ in texts:
-        # The user made it easy, this is a quoted
-        # string, so it's the value.
-        curr_filter["val"] = texts[token.orth_]
-        # If this is just a string, then it's likely
-        # the user wants to search the description.
-        # XXX Not really sure if this would be best
-        # if "name" not in curr_filter:
-        #     curr_filter["name"] = "description"
-        #     curr_filter["op"] = "=~"
-        if "op" not in curr_filter:
-            curr_filter["op"] = "="
-    elif token.lower_ in PRIORITIES and not full:
-        # We already know the list of priorities
-        # and this is an exact match.
-        curr_filter["name"] = "priority"
-        if "op" not in curr_filter:
-            curr_filter["op"] = "="
-        curr_filter["val"] = token.orth_
-    elif token.lower_ in TICKET_TYPES and not full:
-        # We already know the list of ticket types
-        # and this is an exact match.
-        curr_filter["name"] = "type"
-        if "op" not in curr_filter:
-            curr_filter["op"] = "="
-        curr_filter["val"] = TICKET_TYPES[token.orth_]
-    elif (token.orth_ == "higher" and
-                  curr_filter.get("name", "") == "priority"
-          and "val" in curr_filter):
-        # The user want all priorities higher than
-        # the specified one.
-        curr_val = curr_filter["val"]
-        values = PRIORITIES[PRIORITIES.index(curr_val):]
-        curr_filter["list"] = True
-        curr_filter["val"] = values
-    elif (token.orth_ == "lower" and
-            curr_filter.get("name", "") == "priority"
-            and "val" in curr_filter):
-        # The user want all priorities lower than
-        # the specified one.
-        curr_val = curr_filter["val"]
-        values = PRIORITIES[:PRIORITIES.index(curr_val) + 1]
-        curr_filter["list"] = True
-        curr_filter["val"] = values
-    elif token.lower_ in STATUSES and not full:
-        # The user specified the exact status.
-        curr_filter["name"] = "status"
-        if "op" not in curr_filter:
-            curr_filter["op"] = "="
-        curr_filter["val"] = token.orth_
-    elif token.lower_ in RESOLUTIONS and not full:
-        # The user specified the exact resolution.
-        curr_filter["name"] = "resolution"
-        if "op" not in curr_filter:
-            curr_filter["op"] = "="
-        curr_filter["val"] = token.orth_
-    elif (token.lower_ in mes and not full and
-                  "val" not in curr_filter):
-        curr_filter["val"] = user
-    elif ("name" in curr_filter and "op" in curr_filter and
-                  "val" not in curr_filter and
-                  token.pos_ not in ("ADP", "DET", "PUNCT", "CONJ", "DET")
-          ):
-        # We already have the other two,
-        # this is likely the value.
-        # XXX Risky assumption.
-        curr_filter["val"] = token.orth_
-    elif token.orth_ in on_date and level == 0:
-        curr_filter["name"] = "on"
-    elif token.orth_ in start_date and level == 0:
-        curr_filter["name"] = "from"
-    elif token.orth_ in end_date and level == 0:
-        curr_filter["name"] = "to"
-    else:
-        curr_filter["extra_tokens"].append(token)
-        processed = False
 
-    if token.orth_ in TRANSLATE_STATUS_TOKENS:
-        curr_filter["status_tokens"].add(token)
-
-    if processed:
-        already_processed.append(token)
-        if negates and "!" not in curr_filter.get("op", "!"):
-            curr_filter["op"] = curr_filter["op"].replace("=", "=!")
-    for k, v in original_curr_filter.items():
-        if curr_filter.get(k, None) != v:
-            curr_filter[k + "_"] = token
-    logger.debug("Get Filter (level:%s): %s (%s)", level, token, curr_filter)
-    # Go through the semantic tree and figure out the
-    # rest of the filter values.
-    for child in token.children:
-        get_filter(child, texts, user, already_processed, curr_filter,
-                   negates=negates, level=level+1)
-    return curr_filter
+
+@lru_cache(maxsize=4096)
+def _parse_date_text(text, hour):
+    """Parse the date in `text` with dateparser.
+
+    Relative dates depend on when they are parsed, so the current local
+    `hour` is part of the cache key.
+    """
+    return dateparser.parse(text)
 
 
 def parse_date(tokens, already_processed):
@@ -379,6 +478,9 @@ def parse_date(tokens, already_processed):
     number = None
     dtype = None
     ago = False
+    # dateparser uses the local clock, which is not always a whole
+    # number of hours away from UTC.
+    hour = time.localtime()[:4]
     for i in tokens:
         if i.pos_ == "CONJ":
             # We are heading into a different command
@@ -397,7 +499,7 @@ def parse_date(tokens, already_processed):
                 continue
             except (TypeError, ValueError):
                 pass
-        if i.orth_ in ("ago", "last", "past") and not ago:
+        if i.orth_ in ago_words and not ago:
             ago = True
             ago_tokens.append(i)
             continue
@@ -410,10 +512,10 @@ def parse_date(tokens, already_processed):
             # Also known as William Riker
             number = "1"
         logger.debug("Trying to extract date from: %s %s", number, dtype)
-        result = dateparser.parse("%s %s ago" % (number, dtype))
+        result = _parse_date_text("%s %s ago" % (number, dtype), hour)
         if result is not None:
             logger.debug("Extracted date %s from %s", result, stokens)
-            already_processed.extend(ago_tokens)
+            already_processed.update(t.i for t in ago_tokens)
             return result
 
     if len(stokens) == 1 and number is not None:
@@ -422,39 +524,110 @@ def parse_date(tokens, already_processed):
         return
 
     logger.debug("Trying to extract date from: %s", stokens)
-    result = dateparser.parse(" ".join(stokens))
+    result = _parse_date_text(" ".join(stokens), hour)
     if result is not None:
         logger.debug("Extracted date %s from %s", result, stokens)
-        already_processed.extend(rtokens)
+        already_processed.update(t.i for t in rtokens)
         return result
 
     stokens.reverse()
     logger.debug("Trying to extract date from: %s", stokens)
-    result = dateparser.parse(" ".join(stokens))
+    result = _parse_date_text(" ".join(stokens), hour)
     if result is not None:
         logger.debug("Extracted date %s from %s", result, stokens)
-        already_processed.extend(rtokens)
+        already_processed.update(t.i for t in rtokens)
         return result
 
 
+@lru_cache(maxsize=1)
+def get_nlp():
+    """Get the spaCy pipeline.
+
+    Loading it takes seconds and a lot of memory, so this is only done
+    when the first query is parsed rather than on import.
+    """
+    import spacy.en
+    return spacy.en.English()
+
+
+@lru_cache(maxsize=256)
+def _parse(text):
+    """Parse the text with spaCy.
+
+    The resulting documents are only ever read, so the same one can be
+    used for repeated queries. Named entities are never looked at, but the
+    tagger (for `pos_`) and the parser (for the dependency tree walked by
+    `get_filter`) are both needed.
+    """
+    return get_nlp()(text, entity=False)
+
+
 def natural_to_query(query, user):
-    trac_query = []
+    """Convert the natural language `query` of `user` to a Trac query.
+
+    Results are cached, unless `SKIP_CACHE` is set, as the logs
+    explaining how the query was built are missing for cached ones.
+    """
+    # Surrounding whitespace doesn't change the result, but
+    # would make the same query miss the cache.
+    query = query.strip()
+    if SKIP_CACHE:
+        return _natural_to_query(query, user)
+    # dateparser resolves relative dates with the local clock, while
+    # the fixed queries are filled in with the UTC date.
+    day = (datetime.date.today(), datetime.datetime.utcnow().date())
+    trac_query = _cached_natural_to_query(query, user, day)
+    logger.info("Natural query %r is: %s", query, trac_query)
+    return trac_query
+
+
+@lru_cache(maxsize=2048)
+def _cached_natural_to_query(query, user, day):
+    """Relative dates make the result depend on the current `day`, the
+    (local, UTC) dates, which is part of the cache key.
+    """
+    return _natural_to_query(query, user)
+
+
+def _natural_to_query(query, user):
     logger.info("Processing natural query: %r", query)
+    query, texts = _prepare(query)
+    return _query_from_doc(_parse(query), texts, user)
+
+
+def natural_to_query_batch(queries, user):
+    """Convert several natural language `queries` of `user` to Trac
+    queries.
+
+    spaCy parses all of them in one go, which is faster than converting
+    them one at a time. Results are not cached.
+    """
+    prepared = [_prepare(query) for query in queries]
+    docs = get_nlp().pipe([text for text, _ in prepared], entity=False,
+                          batch_size=64)
+    return [_query_from_doc(doc, texts, user)
+            for (_, texts), doc in zip(prepared, docs)]
+
+
+def _prepare(query):
+    """Normalise the natural language `query` before it is parsed.
+
+    Returns the text to parse and the quoted texts it contained.
+    """
+    if isinstance(query, bytes):
+        query = query.decode("utf8")
 
     # Replace quoted string with unique ids, as the
     # user clearly wants us to interpret them as
     # single tokens
     texts = {}
-    inc = 0
-    while True:
-        repl = str(inc) + UNIQUE_M
-        try:
-            text = match_re.search(query).group()
-        except AttributeError:
-            break
-        texts[repl] = text.strip('"\'')
-        query = match_re.sub(repl, query, 1)
-        inc += 1
+
+    def replace_text(match):
+        repl = str(len(texts)) + UNIQUE_M
+        texts[repl] = match.group().strip('"\'')
+        return repl
+
+    query = match_re.sub(replace_text, query)
     query = query.lower()
     logger.debug("Found text search: %s", texts)
     logger.debug("Query: %s", query)
@@ -462,38 +635,31 @@ def natural_to_query(query, user):
     logger.debug("Replace dates: %s", query)
     # Replace any fixed keywords provided in the
     # config file.
-    for i, j in FIXED_QUERIES.items():
-        query = query.replace(i, j)
+    query = replace_fixed_queries(query)
     logger.debug("Replaced fixed queries %r", query)
     # Replace component names with unique ids
     # as those are known to us already
-    for i, j in COMPONENTS.items():
-        query = query.replace(i, j)
+    query = replace_components(query)
     logger.debug("Replaced components %r", query)
-    for i, j in REPL.items():
-        query = query.replace(i, j)
+    query = replace_expressions(query)
     logger.debug("Replaced expressions %r", query)
+    return query, texts
 
-    now = datetime.datetime.utcnow()
 
-    fixed_interpolation = {
-        "user": user,
-        "month": now.strftime("%B"),
-        "year": now.strftime("%Y"),
-        "day": now.strftime("%d"),
-        "last_month": (now - relativedelta(months=1)).strftime("%B"),
-        "last_month_year":
-            (now - relativedelta(months=1)).strftime("%Y"),
-        "last_year": (now - relativedelta(years=1)).strftime("%Y"),
-        "yesterday": (now - relativedelta(days=1)).strftime("%d"),
-    }
+def _query_from_doc(tokens, texts, user):
+    """Build the Trac query from the parsed document of a query that went
+    through `_prepare`.
+    """
+    trac_query = []
+    fixed_interpolation = dict(
+        _date_interpolation(datetime.datetime.utcnow().date()), user=user)
 
     # If we process and accept a token as part
     # of a filter while going through the
     # semantic tree, store it here, so we don't
-    # wrongly reuse it in another filter.
-    already_processed = []
-    tokens = nlp(query.decode("utf8"))
+    # wrongly reuse it in another filter. Tokens
+    # are stored by their index in the document.
+    already_processed = set()
     start_time = None
     end_time = None
     changed = False
@@ -502,7 +668,7 @@ def natural_to_query(query, user):
     resolution_provided = False
     for token in tokens:
         logger.debug("Checking token: %s", token)
-        if token in already_processed:
+        if token.i in already_processed:
             logger.debug("Already processed: %s", token)
             continue
 
@@ -511,7 +677,7 @@ def natural_to_query(query, user):
 
         if token.lower_ in change_modifiers:
             changed = True
-            already_processed.append(token)
+            already_processed.add(token.i)
             continue
 
         if token.orth_ in FIXED_QUERIES_REVERSED:
@@ -529,37 +695,38 @@ def natural_to_query(query, user):
                     trac_query.append(fixed)
             else:
                 trac_query.append(fixed_query)
-            already_processed.append(token)
+            already_processed.add(token.i)
             continue
 
         processed = False
 
         # Try to extract a filter by going trough the
         # semantic tree, starting from this token, while
-        # ignoring any already processed tokens.
-        new_already_processed = list(already_processed)
-        f = get_filter(token, texts, user, new_already_processed)
+        # ignoring any already processed tokens. The
+        # tokens used are only kept if this is a date.
+        f = get_filter(token, texts, user, already_processed)
         logger.debug("Resulting filter: %s", f)
 
-        try:
-            possible_time = parse_date(f["extra_tokens"], new_already_processed)
-            assert possible_time is not None
+        possible_time = parse_date(f["extra_tokens"], already_processed)
+        if possible_time is not None:
             if (start_time is None and end_time is None and
                     f.get("name", "") == "on"):
                 start_time, end_time = possible_time, possible_time
+                continue
             elif start_time is None and ("name" not in f or
-                                       f["name"] == "from"):
+                                         f["name"] == "from"):
                 start_time = possible_time
+                continue
             elif f.get("name", "") == "to" and end_time is None:
                 end_time = possible_time
-            else:
-                raise AssertionError()
-            already_processed = new_already_processed
-            continue
-        except (KeyError, AssertionError):
-            pass
+                continue
+        # Neither the filter nor the date tokens were
+        # processed before, so they can simply be removed.
+        already_processed.difference_update(
+            t.i for t in itertools.chain(f["processed_tokens"],
+                                         f["extra_tokens"]))
 
-        try:
+        if "name" in f and "op" in f and "val" in f:
             # if f["not"]:
             #     f["op"] = f["op"].replace("=", "=!")
             if f["val"] == "me":
@@ -570,12 +737,10 @@ def natural_to_query(query, user):
                 trac_query.append(f["name"] + f["op"] + val)
             # We accepted the filter, update the already
             # processed list.
-            already_processed.append(f["name_"])
-            already_processed.append(f["op_"])
-            already_processed.append(f["val_"])
+            already_processed.add(f["name_"].i)
+            already_processed.add(f["op_"].i)
+            already_processed.add(f["val_"].i)
             processed = True
-        except KeyError:
-            pass
         if processed and f["name"] == "status":
             status_provided = True
         elif processed and f["name"] == "resolution":
@@ -583,19 +748,15 @@ def natural_to_query(query, user):
         # Check if any of the gathered status tokens match
         # the known ones, and add a status filer.
         if f.get("name", "") != "status" or not processed:
-            status_tokens = frozenset([TRANSLATE_STATUS_TOKENS[t.orth_]
-                                       for t in f["status_tokens"]])
-            try:
-                status = TOKENIZED_STATUSES[status_tokens]
+            status = TOKENIZED_STATUSES.get(f["status_mask"])
+            if status is not None:
                 if f["not"]:
                     trac_query.append("status=!" + status)
                 else:
                     trac_query.append("status=" + status)
-                already_processed.extend(f["status_tokens"])
+                already_processed.update(t.i for t in f["status_tokens"])
                 status_provided = True
                 processed = True
-            except KeyError:
-                pass
 
         # Not always right, but good enough.
         if token.lower_ in ("my", "tome") and not processed:
@@ -627,6 +788,7 @@ def natural_to_query(query, user):
 
 
 def main():
+    global SKIP_CACHE
     parser = argparse.ArgumentParser(
         formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     parser.add_argument("query", help="Natural language to convert to "
@@ -643,6 +805,7 @@ def main():
 
     logger.setLevel(logging.DEBUG)
     if args.debug:
+        SKIP_CACHE = True
         sh.setLevel(logging.DEBUG)
     elif args.info:
         sh.setLevel(logging.INFO)
@@ -657,6 +820,12 @@ def main():
             if query == "stop":
                 break
             print(natural_to_query(query, getpass.getuser()))
+    elif query == "batch":
+        # Convert every line of the standard input, letting
+        # spaCy parse them all in one go.
+        queries = [line.strip() for line in sys.stdin if line.strip()]
+        for trac_query in natural_to_query_batch(queries, getpass.getuser()):
+            print(trac_query)
     else:
         print(natural_to_query(query, getpass.getuser()))
 
@@ -1,7 +1,8 @@
+import re
+import os
 import random
 import string
 import logging
-import hashlib
 import unittest
 import datetime
 
@@ -10,12 +11,12 @@ random_sel = string.ascii_letters
 
 
 now = datetime.datetime.utcnow()
-today = datetime.datetime.utcnow().strftime("%Y-%m-%d")
-yesterday = datetime.datetime.utcnow() - datetime.timedelta(days=1)
+today = now.strftime("%Y-%m-%d")
+yesterday = now - datetime.timedelta(days=1)
 yesterday = yesterday.strftime("%Y-%m-%d")
-one_week = datetime.datetime.utcnow() - datetime.timedelta(days=7)
+one_week = now - datetime.timedelta(days=7)
 one_week = one_week.strftime("%Y-%m-%d")
-two_week = datetime.datetime.utcnow() - datetime.timedelta(days=14)
+two_week = now - datetime.timedelta(days=14)
 two_week = two_week.strftime("%Y-%m-%d")
 
 
@@ -31,7 +32,12 @@ moshpit = keywords=moshpit&status=!closed&summary=~metal
 last headbang = reporter=%(user)s&milestone=%(month)s %(year)s
 """
 
-original_config = open("/etc/trac-slack.conf").read()
+try:
+    with open("/etc/trac-slack.conf") as original_file:
+        original_config = original_file.read()
+except (IOError, OSError):
+    original_config = None
+
 
 class NaturalTest(unittest.TestCase):
     @classmethod
@@ -47,6 +53,9 @@ class NaturalTest(unittest.TestCase):
 
     @classmethod
     def tearDownClass(cls):
+        if original_config is None:
+            os.remove("/etc/trac-slack.conf")
+            return
         with open("/etc/trac-slack.conf", "w") as tsf:
             tsf.write(original_config)
 
@@ -184,13 +193,17 @@ CASES = {
     #     u"status=!update_documentation",
 }
 
+
+def case_name(language):
+    """Readable test name for the `language` query."""
+    return "test_" + re.sub(r"\W+", "_", language)[:80]
+
+
 for l, e in CASES.items():
     case = create_test(l, e)
-    case_name = "test_" + hashlib.md5(l).hexdigest()
-    setattr(NaturalTest, case_name, case)
+    setattr(NaturalTest, case_name(l), case)
     l = "show " + l
     case = create_test(l, e)
-    case_name = "test_" + hashlib.md5(l).hexdigest()
-    setattr(NaturalTest, case_name, case)
+    setattr(NaturalTest, case_name(l), case)
 
 
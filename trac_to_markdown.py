@@ -2,55 +2,125 @@
 """Convert Trac's WikiFormat text to Markdown."""
 
 import re
+import collections
 
+from core import lru_cache
+
+
+# The substitutions that differ between the output formats.
+Flavour = collections.namedtuple("Flavour", (
+    "bold", "italic", "ul", "ol", "link", "wiki_link", "ticket_link",
+    "changeset_link", "auto_ticket", "auto_revision", "auto_changeset",
+))
 
 FLAVOURS = {
-    "markdown": {
-        "bold": r"**\1**",
-        "italic": r"*\1*",
-        "ul": r"*\2",
-        "ol": r"\1.\2",
-        "link": r"[[\2|\1]]",
-        "wiki_link": r"[%s/wiki/\2](\1)",
-        "ticket_link": r"[%s/ticket/\2](\1)",
-        "changeset_link": r"[%s/changeset/\2](\1)",
-        "auto_ticket": r"\1[%s/ticket/\2](#\2)",
-        "auto_changeset": r"\1[%s/changeset/\2](\[\2\])",
-    },
+    "markdown": Flavour(
+        bold=r"**\1**",
+        italic=r"*\1*",
+        ul=r"*\2",
+        ol=r"\1.\2",
+        link=r"[[\2|\1]]",
+        wiki_link=r"[%s/wiki/\2](\1)",
+        ticket_link=r"[%s/ticket/\2](\1)",
+        changeset_link=r"[%s/changeset/\2](\1)",
+        auto_ticket=u"[%(base)s/ticket/%(id)s](#%(id)s)",
+        auto_revision=u"[%(base)s/changeset/%(id)s](\\[%(id)s\\])",
+        auto_changeset=u"[%(base)s/changeset/%(id)s](\\[%(id)s\\])",
+    ),
     # mrkdwn is Slack's markup language, which is similar to Markdown.
-    "mrkdwn": {
-        "bold": r"*\1*",
-        "italic": r"_\1_",
-        "ul": u"\\1•\\2",
-        "ol": r"\1\2",
-        "link": r"<\1|\2>",
-        "wiki_link": r"<%s/wiki/\1|\2>",
-        "ticket_link": r"<%s/ticket/\1|\2>",
-        "changeset_link": r"<%s/changeset/\1|\2>",
-        "auto_ticket": r"\1<%s/ticket/\2|#\2>",
-        "auto_changeset": r"\1<%s/changeset/\2|\[\2\]>",
-    },
+    "mrkdwn": Flavour(
+        bold=r"*\1*",
+        italic=r"_\1_",
+        ul=u"\\1•\\2",
+        ol=r"\1\2",
+        link=r"<\1|\2>",
+        wiki_link=r"<%s/wiki/\1|\2>",
+        ticket_link=r"<%s/ticket/\1|\2>",
+        changeset_link=r"<%s/changeset/\1|\2>",
+        auto_ticket=u"<%(base)s/ticket/%(id)s|#%(id)s>",
+        auto_revision=u"<%(base)s/changeset/%(id)s|\\[%(id)s\\]>",
+        auto_changeset=u"<%(base)s/changeset/%(id)s|\\[%(id)s\\]>",
+    ),
 }
 
+# These links show the URL so do not need custom transforms.
+URL_LINKS = {
+    "wiki": u"%(base)s/wiki/%(id)s",
+    "ticket": u"%(base)s/ticket/%(id)s",
+    "changeset": u"%(base)s/changeset/%(id)s",
+}
 
-def convert(text, base="", flavour="markdown"):
-    """Convert the passed text from WikiFormatting to Markdown."""
+
+CODE_BLOCK_RE = re.compile(r"^{{{\s(.*?)\s}}}$", re.DOTALL | re.MULTILINE)
+INLINE_CODE_RE = re.compile(r"\{\{\{([^\n]+?)\}\}\}")
+BOLD_RE = re.compile(r"'''(.+?)'''(?!')")
+ITALIC_RE = re.compile(r"''(.+?)''(?!')")
+HEADING_RE = re.compile(r"(={1,4})[ \t]+(.+?)[ \t]+\1")
+UL_STAR_RE = re.compile(r"(^\s*)\*(\s)", re.MULTILINE)
+UL_DASH_RE = re.compile(r"(^\s*)\-(\s)", re.MULTILINE)
+OL_RE = re.compile(r"^(\s*\d+)\.(\s)", re.MULTILINE)
+WIKI_LINK_RE = re.compile(r"\[(?:wiki:)([^\s]+)\s(.+)\]")
+TICKET_LINK_RE = re.compile(r"\[(?:ticket:)([^\s]+)\s(.+)\]")
+CHANGESET_LINK_RE = re.compile(r"\[(?:changeset:)([^\s]+)\s(.+)\]")
+LINK_RE = re.compile(r"\[([^\s]+)\s(.+)\]")
+# All the automatic links, found in a single pass. The group that
+# matched names the kind of link.
+AUTO_LINK_RE = re.compile(r"""(?<=\s)(?:
+    wiki:(?P<wiki>[A-Za-z0-9]+)(?=\s) |
+    ticket:(?P<ticket>[0-9]+)(?=\s) |
+    changeset:(?P<changeset>[0-9]+)(?=\s) |
+    \#(?P<auto_ticket>\d+)\b |
+    r(?P<auto_revision>\d+)\b |
+    \[(?P<auto_changeset>\d+)\]\b
+)""", re.VERBOSE)
+
+
+def _heading(match):
+    """Get the Markdown heading for a matched Trac one."""
+    return "#" * len(match.group(1)) + " " + match.group(2)
+
+
+@lru_cache(maxsize=32)
+def _resolved_flavour(flavour, base):
+    """Get the `flavour` substitutions with the `base` URL filled in."""
     transforms = FLAVOURS[flavour]
+    return transforms._replace(
+        wiki_link=transforms.wiki_link % base,
+        ticket_link=transforms.ticket_link % base,
+        changeset_link=transforms.changeset_link % base,
+    )
+
+
+@lru_cache(maxsize=2048)
+def convert(text, base="", flavour="markdown"):
+    """Convert the passed text from WikiFormatting to Markdown.
+
+    The same descriptions get converted over and over, so the results
+    are cached.
+    """
+    return _convert(text, base, flavour)
+
+
+def _convert(text, base, flavour):
+    transforms = _resolved_flavour(flavour, base)
 
     # Convert code blocks.
     # XXX This doesn't handle nested blocks, but those should be
     # XXX uncommon. We would probably need to properly parse the text
     # XXX to handle that.
-    text = re.sub(r"^{{{\s(.*?)\s}}}$", r"```\n\1\n```", text,
-                  flags=re.DOTALL | re.MULTILINE)
-    # Also inline code:
-    text = re.sub(r"\{\{\{([^\n]+?)\}\}\}", r"`\1`", text)
+    # Each group of substitutions is skipped when the text doesn't have
+    # the markup it needs, which is often the case for short comments.
+    if "{{{" in text:
+        text = CODE_BLOCK_RE.sub(r"```\n\1\n```", text)
+        # Also inline code:
+        text = INLINE_CODE_RE.sub(r"`\1`", text)
 
     # Convert bold and italic text.
     # Note that it's important to do bold before italic, to avoid having
     # to distinguish them.
-    text = re.sub(r"'''(.+)'''", transforms["bold"], text)
-    text = re.sub(r"''(.+)''", transforms["italic"], text)
+    if "''" in text:
+        text = BOLD_RE.sub(transforms.bold, text)
+        text = ITALIC_RE.sub(transforms.italic, text)
     # Backticks ("monospaced" in Trac terms) and quotes
     # ("Discussion citations") are the same so do not need conversion.
 
@@ -61,44 +131,35 @@ def convert(text, base="", flavour="markdown"):
     # TODO: Line breaks.
     # TODO: Macros (don't know what could be done with these, though).
 
-    # Convert headings.
-    # Again, note that the order is important to keep this simple.
+    # Convert headings, all levels at once.
     # Slack will not handle these specially, but they look nicer in
     # markdown, so keep the same conversion.
-    text = re.sub(r"====\s+(.+?)\s+====", r"#### \1", text)
-    text = re.sub(r"===\s+(.+?)\s+===", r"### \1", text)
-    text = re.sub(r"==\s+(.+?)\s+==", r"## \1", text)
-    text = re.sub(r"=\s+(.+?)\s+=", r"# \1", text)
+    if "=" in text:
+        text = HEADING_RE.sub(_heading, text)
 
     # Convert lists.
-    text = re.sub(r"(^\s*)\*(\s)", transforms["ul"], text, flags=re.MULTILINE)
-    text = re.sub(r"(^\s*)\-(\s)", transforms["ul"], text, flags=re.MULTILINE)
-    text = re.sub(r"^(\s*\d+)\.(\s)", transforms["ol"], text,
-                  flags=re.MULTILINE)
+    if "*" in text:
+        text = UL_STAR_RE.sub(transforms.ul, text)
+    if "-" in text:
+        text = UL_DASH_RE.sub(transforms.ul, text)
+    if "." in text:
+        text = OL_RE.sub(transforms.ol, text)
 
     # Convert links.
-    text = re.sub(r"\[(?:wiki:)([^\s]+)\s(.+)\]",
-                  transforms["wiki_link"] % base, text)
-    text = re.sub(r"\[(?:ticket:)([^\s]+)\s(.+)\]",
-                  transforms["ticket_link"] % base, text)
-    text = re.sub(r"\[(?:changeset:)([^\s]+)\s(.+)\]",
-                  transforms["changeset_link"] % base, text)
-    text = re.sub(r"\[([^\s]+)\s(.+)\]", transforms["link"], text)
+    if "[" in text:
+        text = WIKI_LINK_RE.sub(transforms.wiki_link, text)
+        text = TICKET_LINK_RE.sub(transforms.ticket_link, text)
+        text = CHANGESET_LINK_RE.sub(transforms.changeset_link, text)
+        text = LINK_RE.sub(transforms.link, text)
     # TODO: automatic CamelCase links (which are terrible anyway).
-    # These links show the URL so do not need custom transforms.
-    text = re.sub(r"(\s)wiki:([A-Za-z0-9]+)(\s)",
-                  r"\1%s/wiki/\2\3" % base, text)
-    text = re.sub(r"(\s)ticket:([0-9]+)(\s)",
-                  r"\1%s/ticket/\2\3" % base, text)
     # The automatic linking won't work if the content is the very first
     # text, but I think this is good enough.
-    # Automatic links of #1234 to tickets.
-    text = re.sub(r"(\s)#(\d+)\b", transforms["auto_ticket"] % base, text)
-    # r1234 and [124] to changesets.
+    # Automatic links of #1234 to tickets, r1234 and [124] to changesets
+    # and wiki:, ticket: and changeset: links.
     # XXX Maybe git changeset markers have more than 0-9? Hex?
-    text = re.sub(r"(\s)r(\d+)\b", transforms["auto_changeset"] % base, text)
-    text = re.sub(r"(\s)\[(\d+)\]\b", transforms["auto_changeset"] % base,
-                  text)
-    text = re.sub(r"(\s)changeset:([0-9]+)(\s)",
-                  r"\1%s/changeset/\2\3" % base, text)
+    def auto_link(match):
+        kind = match.lastgroup
+        template = URL_LINKS.get(kind) or getattr(transforms, kind)
+        return template % {"base": base, "id": match.group(kind)}
+    text = AUTO_LINK_RE.sub(auto_link, text)
     return text
@@ -0,0 +1,56 @@
+import unittest
+
+import trac_to_markdown
+
+BASE = "https://trac.example.com"
+
+
+class TracToMarkdownTest(unittest.TestCase):
+    def assertConverts(self, text, expected, flavour="markdown"):
+        result = trac_to_markdown.convert(text, base=BASE, flavour=flavour)
+        self.assertEqual(result, expected, (text, flavour))
+
+    def test_bold(self):
+        self.assertConverts("'''a'''", "**a**")
+        self.assertConverts("'''a'''", "*a*", flavour="mrkdwn")
+
+    def test_italic(self):
+        self.assertConverts("''a''", "*a*")
+        self.assertConverts("''a''", "_a_", flavour="mrkdwn")
+
+    def test_several_emphasis_on_a_line(self):
+        self.assertConverts("'''a''' and '''b''' ''c'' ''d''",
+                            "**a** and **b** *c* *d*")
+        self.assertConverts("'''a''' and '''b''' ''c'' ''d''",
+                            "*a* and *b* _c_ _d_", flavour="mrkdwn")
+
+    def test_bold_italic(self):
+        self.assertConverts("'''''x'''''", "***x***")
+        self.assertConverts("'''''x'''''", "*_x_*", flavour="mrkdwn")
+
+    def test_headings(self):
+        self.assertConverts("= H1 =\n== H2 ==\n=== H3 ===\n==== H4 ====",
+                            "# H1\n## H2\n### H3\n#### H4")
+
+    def test_heading_does_not_cross_lines(self):
+        self.assertConverts("= a\n= b", "= a\n= b")
+
+    def test_url_links(self):
+        self.assertConverts(" wiki:Page ticket:12 changeset:34 ",
+                            " %s/wiki/Page %s/ticket/12 %s/changeset/34 " %
+                            (BASE, BASE, BASE))
+
+    def test_adjacent_url_links(self):
+        self.assertConverts(" ticket:1 ticket:2 ticket:3 ",
+                            " %s/ticket/1 %s/ticket/2 %s/ticket/3 " %
+                            (BASE, BASE, BASE))
+
+    def test_auto_links(self):
+        self.assertConverts(
+            " #12 r34",
+            " [%s/ticket/12](#12) [%s/changeset/34](\\[34\\])" %
+            (BASE, BASE))
+        self.assertConverts(
+            " #12 r34",
+            " <%s/ticket/12|#12> <%s/changeset/34|\\[34\\]>" % (BASE, BASE),
+            flavour="mrkdwn")
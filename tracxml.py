@@ -4,12 +4,42 @@ AccountManager plug-in and uses requests for Session handling.
 
 from __future__ import print_function
 
+import json
+import datetime
+
 try:
     from xmlrpc import client
 except ImportError:
     import xmlrpclib as client
 
+try:
+    from urllib import parse as urlparse
+except ImportError:
+    import urlparse
+
 import requests
+import requests.adapters
+import jsonrpclib.jsonrpc
+
+from core import json_loads
+
+
+def _create_session():
+    """Create a session that keeps its connections to Trac alive.
+
+    All the transports share this session, so consecutive RPC calls reuse
+    an already established connection instead of doing a new (TLS)
+    handshake for each call.
+    """
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=4,
+                                            pool_maxsize=64, max_retries=0)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+SESSION = _create_session()
 
 
 class RequestsTransport(client.Transport):
@@ -17,58 +47,102 @@ class RequestsTransport(client.Transport):
     # This might work, but haven't tested
     accept_gzip_encoding = False
     _content_type = "text/xml"
+    # Seconds to wait for Trac before giving up on a call.
+    timeout = 30
+    # Bytes read from the response for each feed to the parser.
+    chunk_size = 65536
 
     def __init__(self, use_datetime=0):
         client.Transport.__init__(self, use_datetime=use_datetime)
-        self.session = requests.Session()
+        self.session = SESSION
+        self._authed = False
+        # requests doesn't modify the headers, so they are only built once.
+        self._headers = {"User-Agent": self.user_agent,
+                         "Content-Type": self._content_type}
+        if self._extra_headers:
+            self._headers.update(self._extra_headers)
 
     def auth_trac(self, host, auth_details):
         if self.is_auth():
             return
         # Do a get first so the trac_form_token cookie is set in the session
-        self.session.get(self.get_url(host, "/login"))
+        self.session.get(self.get_url(host, "/login"), timeout=self.timeout)
         form_token = self.session.cookies["trac_form_token"].split(";")[0]
 
         user, password = auth_details.split(":", 1)
         self.session.post(self.get_url(host, "/login"),
                           data={"user": user, "password": password,
-                                "__FORM_TOKEN": form_token})
+                                "__FORM_TOKEN": form_token},
+                          timeout=self.timeout)
 
     def is_auth(self):
-        return "trac_auth" in self.session.cookies
+        # Once logged in, skip looking through the cookie jar on every call.
+        if not self._authed:
+            self._authed = "trac_auth" in self.session.cookies
+        return self._authed
+
+    def login_lost(self, response):
+        """Check if the call was refused or redirected to the login."""
+        if response.status_code in (401, 403):
+            return True
+        return (bool(response.history) and
+                urlparse.urlparse(response.url).path == "/login")
+
+    def forget_auth(self):
+        """Drop the Trac login, so the next call logs in again."""
+        self._authed = False
+        cookies = self.session.cookies
+        # There may be a trac_auth cookie for more than one path or domain.
+        for cookie in list(cookies):
+            if cookie.name == "trac_auth":
+                cookies.clear(cookie.domain, cookie.path, cookie.name)
 
     def get_url(self, host, handler):
         return "%s://%s%s" % (self.proto, host, handler)
 
+    def post(self, host, handler, request_body):
+        return self.session.post(self.get_url(host, handler),
+                                 data=request_body, headers=self._headers,
+                                 timeout=self.timeout)
+
     def single_request(self, host, handler, request_body, verbose=0):
+        auth_details = None
         if "@" in host:
             auth_details, host = host.rsplit("@", 1)
             self.auth_trac(host, auth_details)
 
-        headers = {"User-Agent": self.user_agent,
-                   "Content-Type": self._content_type}
-        if self._extra_headers:
-            headers.update(dict(self._extra_headers))
+        response = self.post(host, handler, request_body)
 
-        response = self.session.get(self.get_url(host, handler),
-                                    data=request_body, headers=headers)
+        if self.login_lost(response) and auth_details is not None:
+            # Trac dropped the session, log in again and retry once.
+            response.close()
+            self.forget_auth()
+            self.auth_trac(host, auth_details)
+            response = self.post(host, handler, request_body)
 
-        if response.ok:
+        if self.login_lost(response):
+            self.forget_auth()
+        elif response.ok:
             self.verbose = verbose
             return self.parse_response(response)
 
         response.close()
 
-        raise client.ProtocolError(host + handler, response.status_codes,
+        if response.ok:
+            # Redirected to the login page.
+            raise client.ProtocolError(host + handler, 401, "Login required",
+                                       "")
+        raise client.ProtocolError(host + handler, response.status_code,
                                    response.reason, "")
 
     def parse_response(self, response):
         p, u = self.getparser()
 
-        for line in response.iter_lines():
+        # The parsers accept data in any chunks, no need to split lines.
+        for chunk in response.iter_content(chunk_size=self.chunk_size):
             if self.verbose:
-                print("body:", repr(line))
-            p.feed(line)
+                print("body:", repr(chunk))
+            p.feed(chunk)
 
         response.close()
         p.close()
@@ -80,74 +154,135 @@ class SafeRequestsTransport(RequestsTransport):
     proto = "https"
 
 
-try:
-    import jsonrpclib.jsonrpc
-except ImportError:
-    pass
-else:
-    import json
-    import datetime
-
-    class JSONRequestsTransport(RequestsTransport):
-        """Extends the XMLRPC transport where necessary."""
-        _connection = (None, None)
-        _extra_headers = []
-        _content_type = "application/json"
-
-        def send_content(self, connection, request_body):
-            connection.putheader("Content-Type", "application/json")
-            connection.putheader("Content-Length", str(len(request_body)))
-            connection.endheaders()
-            if request_body:
-                connection.send(request_body)
-
-        def getparser(self):
-            target = jsonrpclib.jsonrpc.JSONTarget()
-            return jsonrpclib.jsonrpc.JSONParser(target), target
-
-    class SafeJSONRequestsTransport(JSONRequestsTransport):
-        proto = "https"
-
-
-    def _recursive_to_datetime(data):
-        """Iterate through this object converting datetime objects."""
-        if isinstance(data, basestring):
-            # Strings are iterable, but don't contain other objects
-            # (other than shorter strings).
-            return data
-        try:
-            data_type, data_value = data["__jsonclass__"]
-            assert data_type == "datetime"
-        except (TypeError, IndexError, KeyError):
-            # This is not a dictionary, or not the special one.
-            pass
+def multicall(proxy, calls):
+    """Issue several RPC calls to Trac in a single request.
+
+    `calls` is a list of (method name, params) tuples. Returns a list with
+    the result of each call in the same order, or a `client.Fault` for the
+    calls that failed. Works for both Trac's XML-RPC and JSON-RPC protocols.
+    """
+    signatures = []
+    for call_id, (method, params) in enumerate(calls):
+        # XML-RPC expects "methodName" and JSON-RPC "method", the other
+        # key is ignored by each protocol.
+        signatures.append({"methodName": method, "method": method,
+                           "params": list(params), "id": call_id})
+    results = []
+    for result in proxy.system.multicall(signatures):
+        if isinstance(result, dict) and "faultCode" in result:
+            # XML-RPC fault.
+            results.append(client.Fault(result["faultCode"],
+                                        result["faultString"]))
+        elif isinstance(result, dict):
+            # JSON-RPC returns a full response object for each call.
+            error = result.get("error")
+            if error:
+                results.append(client.Fault(error.get("code"),
+                                            error.get("message")))
+            else:
+                results.append(result["result"])
+        else:
+            # XML-RPC wraps each successful result in a list.
+            results.append(result[0])
+    return results
+
+
+class JSONRequestsTransport(RequestsTransport):
+    """Extends the XMLRPC transport where necessary."""
+    _connection = (None, None)
+    _extra_headers = []
+    _content_type = "application/json"
+
+    def send_content(self, connection, request_body):
+        connection.putheader("Content-Type", "application/json")
+        connection.putheader("Content-Length", str(len(request_body)))
+        connection.endheaders()
+        if request_body:
+            connection.send(request_body)
+
+    def getparser(self):
+        target = jsonrpclib.jsonrpc.JSONTarget()
+        return jsonrpclib.jsonrpc.JSONParser(target), target
+
+
+class SafeJSONRequestsTransport(JSONRequestsTransport):
+    proto = "https"
+
+
+def _parse_datetime(value):
+    """Parse Trac's "%Y-%m-%dT%H:%M:%S" timestamps.
+
+    Slicing the fixed width fields is a lot faster than strptime.
+    """
+    if (len(value) != 19 or value[4] != "-" or value[7] != "-" or
+            value[10] != "T" or value[13] != ":" or value[16] != ":" or
+            not value.replace("-", "").replace(":", "")
+            .replace("T", "").isdigit()):
+        # Let strptime complain about anything else.
+        return datetime.datetime.strptime(value, "%Y-%m-%dT%H:%M:%S")
+    return datetime.datetime(int(value[0:4]), int(value[5:7]),
+                             int(value[8:10]), int(value[11:13]),
+                             int(value[14:16]), int(value[17:19]))
+
+
+def _to_datetime(data):
+    """Get the datetime for Trac's JSON representation of one, or None
+    if `data` is anything else.
+    """
+    if isinstance(data, dict):
+        jsonclass = data.get("__jsonclass__")
+        if (isinstance(jsonclass, list) and len(jsonclass) == 2 and
+                jsonclass[0] == "datetime"):
+            return _parse_datetime(jsonclass[1])
+    return None
+
+
+def _convert_datetimes(data):
+    """Convert the datetime objects in the decoded JSON `data`.
+
+    Dictionaries and lists are updated in place.
+    """
+    converted = _to_datetime(data)
+    if converted is not None:
+        return converted
+    stack = [data] if isinstance(data, (dict, list)) else []
+    while stack:
+        container = stack.pop()
+        if isinstance(container, dict):
+            items = container.items()
         else:
-            return datetime.datetime.strptime(data_value,
-                                              "%Y-%m-%dT%H:%M:%S")
-        if hasattr(data, "items"):
-            new_dict = {}
-            for key, value in data.items():
-                key = _recursive_to_datetime(key)
-                value = _recursive_to_datetime(value)
-                new_dict[key] = value
-            return new_dict
-        try:
-            new_iter = data.__class__()
-            for item in data:
-                new_iter += data.__class__([_recursive_to_datetime(item)])
-            return new_iter
-        except TypeError:
-            return data
-
-
-    def loads(data):
-        """Convert timestamp data to appropriate formats."""
-        # We also skip past the jsonclass and jloads stuff since we are
-        # not using that.
-        if data == "":
-            # Notification.
-            return None
-        result = json.loads(data)
-        return _recursive_to_datetime(result)
-
-    jsonrpclib.jsonrpc.loads = loads
+            items = enumerate(container)
+        for key, value in items:
+            if not isinstance(value, (dict, list)):
+                continue
+            converted = _to_datetime(value)
+            if converted is None:
+                stack.append(value)
+            else:
+                container[key] = converted
+    return data
+
+
+def _datetime_hook(data):
+    """object_hook that converts the datetime objects while decoding."""
+    converted = _to_datetime(data)
+    return data if converted is None else converted
+
+
+def loads(data):
+    """Convert timestamp data to appropriate formats."""
+    # We also skip past the jsonclass and jloads stuff since we are
+    # not using that.
+    if data == "":
+        # Notification.
+        return None
+    if json_loads is json.loads:
+        # The standard library decoder can convert the datetimes while
+        # parsing, which saves walking the result again.
+        return json.loads(data, object_hook=_datetime_hook)
+    # orjson and ujson don't support object hooks.
+    result = json_loads(data)
+    return _convert_datetimes(result)
+
+
+jsonrpclib.jsonrpc.loads = loads
@@ -0,0 +1,164 @@
+import unittest
+
+import requests.cookies
+
+import tracxml
+
+
+RPC_RESPONSE = (b"<?xml version='1.0'?><methodResponse><params><param>"
+                b"<value><string>ok</string></value>"
+                b"</param></params></methodResponse>")
+
+
+class FakeResponse(object):
+    def __init__(self, status_code, reason, body=b"",
+                 url="https://trac.example.com/login/rpc", history=()):
+        self.status_code = status_code
+        self.reason = reason
+        self.ok = status_code < 400
+        self.body = body
+        self.url = url
+        self.history = list(history)
+        self.closed = False
+
+    def iter_content(self, chunk_size=1):
+        yield self.body
+
+    def close(self):
+        self.closed = True
+
+
+class FakeSession(object):
+    """Answers the RPC calls with `responses`, in order, and logs in
+    like Trac's AccountManager.
+    """
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.cookies = requests.cookies.RequestsCookieJar()
+        self.logins = 0
+        self.timeouts = []
+
+    def get(self, url, **kwargs):
+        self.timeouts.append(kwargs.get("timeout"))
+        self.cookies.set("trac_form_token", "token")
+        return FakeResponse(200, "OK")
+
+    def post(self, url, **kwargs):
+        self.timeouts.append(kwargs.get("timeout"))
+        if url.endswith("/login"):
+            self.logins += 1
+            self.cookies.set("trac_auth", "fresh")
+            return FakeResponse(200, "OK")
+        return self.responses.pop(0)
+
+
+class RequestsTransportTest(unittest.TestCase):
+    def test_failed_call_raises_protocol_error(self):
+        response = FakeResponse(500, "Internal Server Error")
+        transport = tracxml.SafeRequestsTransport()
+        transport.session = FakeSession(response)
+        with self.assertRaises(tracxml.client.ProtocolError) as context:
+            transport.single_request("trac.example.com", "/rpc", "<xml/>")
+        self.assertEqual(context.exception.errcode, 500)
+        self.assertEqual(context.exception.errmsg, "Internal Server Error")
+        self.assertTrue(response.closed)
+
+    def test_redirect_to_rpc_keeps_login(self):
+        # E.g. an http to https redirect ending on the RPC endpoint.
+        response = FakeResponse(200, "OK", RPC_RESPONSE,
+                                history=[FakeResponse(301, "Moved")])
+        transport = tracxml.SafeRequestsTransport()
+        transport.session = FakeSession(response)
+        transport.session.cookies.set("trac_auth", "good")
+        result = transport.single_request("user:pw@trac.example.com",
+                                          "/login/rpc", "<xml/>")
+        self.assertEqual(result, ("ok",))
+        self.assertEqual(transport.session.cookies["trac_auth"], "good")
+        self.assertEqual(transport.session.logins, 0)
+
+    def test_lost_login_drops_every_trac_auth_cookie(self):
+        transport = tracxml.SafeRequestsTransport()
+        transport.session = FakeSession(FakeResponse(403, "Forbidden"))
+        cookies = transport.session.cookies
+        cookies.set("trac_auth", "old", domain="trac.example.com", path="/")
+        cookies.set("trac_auth", "old", domain="trac.example.com",
+                    path="/login")
+        with self.assertRaises(tracxml.client.ProtocolError) as context:
+            transport.single_request("trac.example.com", "/login/rpc",
+                                     "<xml/>")
+        self.assertEqual(context.exception.errcode, 403)
+        self.assertNotIn("trac_auth", [cookie.name for cookie in cookies])
+        self.assertFalse(transport.is_auth())
+
+    def test_lost_login_logs_in_again_and_retries(self):
+        lost = FakeResponse(200, "OK", url="https://trac.example.com/login",
+                            history=[FakeResponse(302, "Found")])
+        transport = tracxml.SafeRequestsTransport()
+        transport.session = FakeSession(
+            lost, FakeResponse(200, "OK", RPC_RESPONSE))
+        transport.session.cookies.set("trac_auth", "expired")
+        result = transport.single_request("user:pw@trac.example.com",
+                                          "/login/rpc", "<xml/>")
+        self.assertEqual(result, ("ok",))
+        self.assertTrue(lost.closed)
+        self.assertEqual(transport.session.logins, 1)
+        self.assertEqual(transport.session.cookies["trac_auth"], "fresh")
+        # The login is bounded like the calls themselves.
+        self.assertEqual(transport.session.timeouts,
+                         [transport.timeout] * 4)
+
+
+class FakeProxy(object):
+    """Answers system.multicall with `results`."""
+    def __init__(self, results):
+        self.system = self
+        self.results = results
+        self.signatures = None
+
+    def multicall(self, signatures):
+        self.signatures = signatures
+        return self.results
+
+
+class MulticallTest(unittest.TestCase):
+    calls = [("ticket.get", (1,)), ("ticket.get", (2,)),
+             ("ticket.get", (3,))]
+
+    def assertFault(self, result, code, message):
+        self.assertIsInstance(result, tracxml.client.Fault)
+        self.assertEqual(result.faultCode, code)
+        self.assertEqual(result.faultString, message)
+
+    def test_signatures(self):
+        proxy = FakeProxy([[None], [None], [None]])
+        tracxml.multicall(proxy, self.calls)
+        self.assertEqual(proxy.signatures, [
+            {"methodName": "ticket.get", "method": "ticket.get",
+             "params": [number], "id": number - 1}
+            for number in (1, 2, 3)
+        ])
+
+    def test_xmlrpc_results(self):
+        proxy = FakeProxy([
+            ["first"],
+            {"faultCode": 404, "faultString": "Ticket 2 does not exist."},
+            ["third"],
+        ])
+        results = tracxml.multicall(proxy, self.calls)
+        self.assertEqual(len(results), 3)
+        self.assertEqual(results[0], "first")
+        self.assertFault(results[1], 404, "Ticket 2 does not exist.")
+        self.assertEqual(results[2], "third")
+
+    def test_jsonrpc_results(self):
+        proxy = FakeProxy([
+            {"result": "first", "error": None, "id": 0},
+            {"result": None, "id": 1,
+             "error": {"code": 404, "message": "Ticket 2 does not exist."}},
+            {"result": "third", "error": None, "id": 2},
+        ])
+        results = tracxml.multicall(proxy, self.calls)
+        self.assertEqual(len(results), 3)
+        self.assertEqual(results[0], "first")
+        self.assertFault(results[1], 404, "Ticket 2 does not exist.")
+        self.assertEqual(results[2], "third")